@@ -0,0 +1,271 @@
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import matching_algorithms as ma
+from switching_stats import PAYOUT_LEVELS, SwitchEstimator
+
+# Latency / peak memory of the matching functions over a sweep of group sizes and option sparsity.
+# Results can be saved as a JSON baseline; later runs compared against it flag regressions.
+# Also measures the cold import time of the modules every oTree / simulation worker process loads.
+
+PLAYERS = [4, 16, 64, 256]
+SLOTS_PER_PLAYER = [1.5, 4]		# nslots = nplayers * factor
+SPARSITY = [0.0, 0.9]			# fraction of each switching player's slots that are unavailable
+REMAINING = 0.5					# fraction of players that remain (single option)
+IMPORTED = ['matching_algorithms', 'switching_stats', 'simulation']
+
+
+# synthetic round: options dicts as Group.make_options builds them
+def synthetic_options(nplayers, nslots, sparsity, rng):
+	source = ma.PayoffSource(int(rng.integers(1 << 31)), nslots)
+	order = rng.permutation(nslots)
+	options = {}
+	for p_id in range(nplayers):
+		if rng.random() < REMAINING:
+			sm_id = int(order[p_id])
+			options[p_id] = {sm_id: int(source.row(1, p_id)[sm_id])}
+		else:
+			taken = 0
+			for sm_id in np.flatnonzero(rng.random(nslots) < sparsity):
+				taken |= 1 << int(sm_id)
+			options[p_id] = ma.available_options(source.row(1, p_id), taken, nslots)
+	return options
+
+
+def synthetic_probs(rng):
+	estimator = SwitchEstimator()
+	estimator.update(rng.integers(0, 21, size=200), rng.random(200) < 0.3)
+	return estimator.predict()
+
+
+# Group.match_pay without the database: matrices and solve for the group's treatment
+def match_pay_pipeline(options, nslots, nplayers, alg, solver, q):
+	prob = None if alg == 'fair' else q
+	if solver == 'sparse':
+		return ma.sparse_matching(options, nslots, nplayers, prob)
+	matrices = ma.build_matrices(options, nslots, nplayers, prob)
+	if alg == 'fair':
+		return ma.fair_matching(options, nslots, nplayers, matrices, solver)
+	return ma.self_matching(options, nslots, nplayers, prob, matrices, solver)
+
+
+# (name, shape, fn(options, q)) per benchmarked call
+def cases(solvers):
+	for n, factor, sparsity in itertools.product(PLAYERS, SLOTS_PER_PLAYER, SPARSITY):
+		m = int(n * factor)
+		shape = dict(nplayers=n, nslots=m, sparsity=sparsity)
+		yield 'correlated_payoffs_batch', shape, lambda o, q, n=n, m=m: ma.correlated_payoffs_batch(m, n, 8)
+		yield 'payoff_matrix', shape, lambda o, q, n=n, m=m: ma.payoff_matrix(o, m, n)
+		yield 'probability_matrix', shape, lambda o, q, n=n, m=m: ma.probability_matrix(o, m, n, q)
+		yield 'self_matching', shape, lambda o, q, n=n, m=m: ma.self_matching(o, m, n, q)
+		for solver in solvers:
+			yield 'fair_matching[%s]' % solver, shape, lambda o, q, n=n, m=m, s=solver: ma.fair_matching(o, m, n, solver=s)
+			for alg in ('fair', 'self'):
+				yield 'match_pay[%s,%s]' % (alg, solver), shape, lambda o, q, n=n, m=m, a=alg, s=solver: match_pay_pipeline(o, m, n, a, s, q)
+
+
+def measure(fn, options, prob, repeat):
+	times = []
+	for i in range(repeat):
+		start = time.perf_counter()
+		fn(options, prob)
+		times.append(time.perf_counter() - start)
+
+	tracemalloc.start()
+	fn(options, prob)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+
+	p50, p90, p99 = np.percentile(times, [50, 90, 99]) * 1000
+	return dict(p50_ms=p50, p90_ms=p90, p99_ms=p99, peak_kb=peak / 1024.)
+
+
+def run(solvers, repeat, seed=0, max_players=None):
+	rng = np.random.default_rng(seed)
+	prob = synthetic_probs(rng)
+	results = {}
+	options_cache = {}
+	for name, shape, fn in cases(solvers):
+		if max_players and shape['nplayers'] > max_players:
+			continue
+		key = (shape['nplayers'], shape['nslots'], shape['sparsity'])
+		if key not in options_cache:
+			options_cache.clear()
+			options_cache[key] = synthetic_options(shape['nplayers'], shape['nslots'], shape['sparsity'], rng)
+		case = '%s n=%d m=%d sparsity=%.2f' % ((name,) + key)
+		results[case] = dict(shape, **measure(fn, options_cache[key], prob, repeat))
+		print("%-60s p50 %8.3f ms  p99 %8.3f ms  peak %9.1f kB" % (case, results[case]['p50_ms'], results[case]['p99_ms'], results[case]['peak_kb']))
+	return results
+
+
+# wall time of importing module in a fresh interpreter, numpy included
+def import_time(module, repeat):
+	code = "import time; start = time.perf_counter(); import %s; print(time.perf_counter() - start)" % module
+	here = os.path.dirname(os.path.abspath(__file__))
+	times = [float(subprocess.check_output([sys.executable, '-c', code], cwd=here)) for i in range(repeat)]
+	p50, p90, p99 = np.percentile(times, [50, 90, 99]) * 1000
+	return dict(p50_ms=p50, p90_ms=p90, p99_ms=p99)
+
+
+def run_imports(repeat):
+	results = {}
+	for module in IMPORTED:
+		case = 'import %s' % module
+		results[case] = import_time(module, repeat)
+		print("%-60s p50 %8.3f ms  p99 %8.3f ms" % (case, results[case]['p50_ms'], results[case]['p99_ms']))
+	return results
+
+
+# Equivalence checks (--verify): each matching must reach the optimum of a cold linear_sum_assignment
+def objective(weight, row_ind, col_ind):
+	return float(weight[row_ind, col_ind].sum())
+
+
+# next round's options as Group.make_options builds them from a matching: some players remain, the rest switch
+def next_options(options, col_ind, matrices, nslots, rng):
+	source = ma.PayoffSource(int(rng.integers(1 << 31)), nslots)
+	options_next = {p_id: {int(col_ind[p_id]): int(matrices.payoff[p_id, col_ind[p_id]])} for p_id in options
+	                if rng.random() < REMAINING and matrices.mask[p_id, col_ind[p_id]]}
+	taken = 0
+	for opts in options_next.values():
+		taken |= 1 << next(iter(opts))
+	for p_id in options:
+		if p_id not in options_next:
+			options_next[p_id] = ma.available_options(source.row(1, p_id), taken, nslots)
+	return options_next
+
+
+# incremental_matching over a few rounds, warm-started from the previous round's state, against cold solves
+def verify_incremental(problems, rng, rounds=4):
+	failures = []
+	for k in range(problems):
+		n = int(rng.integers(2, 17))
+		m = n + int(rng.integers(0, n + 4))
+		q = synthetic_probs(rng) if k % 2 else None
+		options = synthetic_options(n, m, float(rng.choice(SPARSITY)), rng)
+		state = None
+		for round_number in range(rounds):
+			matrices = ma.build_matrices(options, m, n, q)
+			weight = matrices.payoff if q is None else matrices.prob
+			row_ind, col_ind, pay_amts, state = ma.incremental_matching(options, m, n, state, q, matrices)
+			if not np.isclose(objective(weight, row_ind, col_ind), objective(weight, *ma.scipy_solver(weight))):
+				failures.append('incremental_matching problem %d round %d n=%d m=%d' % (k, round_number, n, m))
+			options = next_options(options, col_ind, matrices, m, rng)
+	return failures
+
+
+# the sparse solver and every registered backend besides the 'scipy' reference, for both treatments' weights,
+# against a cold linear_sum_assignment
+def verify_solvers(problems, rng):
+	failures = []
+	for k in range(problems):
+		n = int(rng.integers(2, 65))
+		m = int(n * rng.choice(SLOTS_PER_PLAYER))
+		q = synthetic_probs(rng) if k % 2 else None
+		options = synthetic_options(n, m, float(rng.choice(SPARSITY)), rng)
+		matrices = ma.build_matrices(options, m, n, q)
+		weight = matrices.payoff if q is None else matrices.prob
+		rows = matrices.mask.any(axis=1)		# players without options take any slot in the dense solve
+		expected = objective(weight * rows[:, None], *ma.scipy_solver(weight))
+		for solver in sorted(set(ma.SOLVERS) - {'scipy'}) + ['sparse']:
+			p_ids, sm_ids, pay_amts = ma.match_options(options, m, n, q, solver)
+			keep = rows[p_ids]
+			if not np.isclose(objective(weight, np.asarray(p_ids)[keep], np.asarray(sm_ids)[keep]), expected):
+				failures.append('%s problem %d n=%d m=%d' % (solver, k, n, m))
+	return failures
+
+
+def synthetic_decisions(rng):
+	size = int(rng.integers(0, 9))
+	return rng.integers(0, PAYOUT_LEVELS, size=size), rng.random(size) < 0.3
+
+
+# fingerprint of a 'self' group's async plan / speculation (SwitchEstimator.updated, as models.planned_probs)
+# against the one its wait page computes after storing the updated shard (Group.record_decisions,
+# then Subsession.switch_estimator); groups without a stored shard yet fall back to the session config
+def verify_planned_probs(problems, rng):
+	failures = []
+	for k in range(problems):
+		config = {'switch_pseudo_count': int(rng.integers(0, 10)), 'switch_decay': float(rng.choice([1.0, 0.9, 0.37]))}
+		fields = []
+		for g in range(int(rng.integers(1, 5))):
+			shard = SwitchEstimator.from_config(config)
+			for round_number in range(int(rng.integers(0, 5))):
+				shard = shard.updated(*synthetic_decisions(rng))
+			fields.append(shard.dumps() if rng.random() < 0.8 else None)
+		group = int(rng.integers(len(fields)))
+		pays, switched = synthetic_decisions(rng)
+
+		shards = [SwitchEstimator.loads(field, config) for field in fields]
+		shards[group] = shards[group].updated(pays, switched)
+		planned = SwitchEstimator.merge(shards).predict()
+
+		recorded = SwitchEstimator.loads(fields[group], config)
+		recorded.update(pays, switched)
+		stored = fields[:group] + [recorded.dumps()] + fields[group + 1:]
+		waited = SwitchEstimator.merge(SwitchEstimator.loads(field, config) for field in stored).predict()
+
+		options = synthetic_options(4, 14, 0.0, rng)
+		if ma.options_fingerprint(options, planned, 'scipy', 'self') != ma.options_fingerprint(options, waited, 'scipy', 'self'):
+			failures.append('planned switching probabilities problem %d groups=%d' % (k, len(fields)))
+	return failures
+
+
+def verify(problems, seed=0):
+	rng = np.random.default_rng(seed)
+	failures = verify_incremental(problems, rng) + verify_solvers(problems, rng) + verify_planned_probs(problems, rng)
+	for failure in failures:
+		print("MISMATCH %s" % failure)
+	print("verified %d problems, %d mismatches" % (problems, len(failures)))
+	return failures
+
+
+# cases whose p50 latency grew by more than tolerance (relative) over the baseline
+def regressions(results, baseline, tolerance):
+	slower = []
+	for case, result in results.items():
+		if case in baseline and result['p50_ms'] > baseline[case]['p50_ms'] * (1 + tolerance):
+			slower.append((case, baseline[case]['p50_ms'], result['p50_ms']))
+	return slower
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Benchmark the matching functions")
+	parser.add_argument('--solvers', default=','.join(sorted(ma.SOLVERS) + ['sparse']))
+	parser.add_argument('--repeat', type=int, default=20)
+	parser.add_argument('--max-players', type=int, default=None)
+	parser.add_argument('--save', metavar='JSON', help="write the results as a baseline")
+	parser.add_argument('--compare', metavar='JSON', help="flag regressions against a saved baseline")
+	parser.add_argument('--tolerance', type=float, default=0.25, help="allowed relative p50 slowdown")
+	parser.add_argument('--import-budget-ms', type=float, default=None, help="fail if a module's p50 import time exceeds this")
+	parser.add_argument('--imports-only', action='store_true', help="only measure import times")
+	parser.add_argument('--verify', type=int, metavar='N', default=None, help="only check N random problems against cold solves")
+	args = parser.parse_args()
+
+	if args.verify is not None:
+		sys.exit(1 if verify(args.verify) else 0)
+
+	results = run_imports(min(args.repeat, 10))
+	over_budget = [case for case, result in results.items() if args.import_budget_ms and result['p50_ms'] > args.import_budget_ms]
+	for case in over_budget:
+		print("OVER BUDGET %s: p50 %.3f ms > %.3f ms" % (case, results[case]['p50_ms'], args.import_budget_ms))
+	if not args.imports_only:
+		results.update(run(args.solvers.split(','), args.repeat, max_players=args.max_players))
+	if args.save:
+		with open(args.save, 'w') as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+	if args.compare:
+		with open(args.compare) as f:
+			slower = regressions(results, json.load(f), args.tolerance)
+		for case, before, after in slower:
+			print("REGRESSION %s: p50 %.3f ms --> %.3f ms" % (case, before, after))
+		sys.exit(1 if slower or over_budget else 0)
+	sys.exit(1 if over_budget else 0)
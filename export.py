@@ -0,0 +1,128 @@
+import json
+import os
+
+import numpy as np
+
+# Streaming columnar export of per-round matching data, one row per (session, round, group).
+# Rows are buffered chunk_rows at a time and written as one .npy file per column and chunk,
+# so an export of any size runs in bounded memory; load_columns memory-maps the chunks back.
+#
+# From an oTree shell:
+#     from matchingAlg import export
+#     export.export_sessions(['<session code>'], 'matching_export')
+
+ALGS = ['fair', 'self', 'maxmin']		# alg column holds the index into this list
+UNSET = -1								# no value (unavailable option, unmatched, no decision)
+
+
+# name --> (dtype, shape of one row)
+def columns(nplayers, nslots):
+	return {
+		'session': ('U16', ()),
+		'round': (np.int16, ()),
+		'group': (np.int16, ()),
+		'super_group': (np.int16, ()),
+		'alg': (np.int8, ()),
+		'options': (np.int8, (nplayers, nslots)),		# payoff per (role, sm_id), UNSET if unavailable
+		'assignment': (np.int16, (nplayers,)),			# sm_id per role
+		'payoff': (np.int16, (nplayers,)),				# payoff_current per role
+		'decision': (np.int8, (nplayers,)),				# offer_accepted per role (1 remain, 2 switch, 3 quit)
+		'switch_probs': (np.float32, (21,)),			# session-wide switching probabilities per payout
+	}
+
+
+class ColumnarWriter:
+	def __init__(self, directory, nplayers, nslots, chunk_rows=4096):
+		self.directory = directory
+		self.columns = columns(nplayers, nslots)
+		self.chunk_rows = chunk_rows
+		self.chunks = 0
+		self.rows = 0
+		self._buffers = {name: np.empty((chunk_rows,) + shape, dtype=dtype) for name, (dtype, shape) in self.columns.items()}
+		self._filled = 0
+		os.makedirs(directory, exist_ok=True)
+
+	def write(self, row):
+		for name, buffer in self._buffers.items():
+			buffer[self._filled] = row[name]
+		self._filled += 1
+		if self._filled == self.chunk_rows:
+			self.flush()
+
+	def flush(self):
+		if self._filled == 0:
+			return
+		for name, buffer in self._buffers.items():
+			np.save(os.path.join(self.directory, '%s.%05d.npy' % (name, self.chunks)), buffer[:self._filled])
+		self.rows += self._filled
+		self.chunks += 1
+		self._filled = 0
+
+	def close(self):
+		self.flush()
+		manifest = {'rows': self.rows, 'chunks': self.chunks, 'algs': ALGS,
+		            'columns': {name: [np.dtype(dtype).str, list(shape)] for name, (dtype, shape) in self.columns.items()}}
+		with open(os.path.join(self.directory, 'manifest.json'), 'w') as f:
+			json.dump(manifest, f, indent=1)
+
+
+# name --> list of read-only memory-mapped chunks, in row order
+def load_columns(directory):
+	with open(os.path.join(directory, 'manifest.json')) as f:
+		manifest = json.load(f)
+	return {name: [np.load(os.path.join(directory, '%s.%05d.npy' % (name, chunk)), mmap_mode='r')
+	               for chunk in range(manifest['chunks'])]
+	        for name in manifest['columns']}
+
+
+def _int(value):
+	return UNSET if value is None else int(value)
+
+
+# one export row from a group's round, as written by Group.record_decisions / make_options / match_pay
+def round_row(session, group, switch_probs, nplayers, nslots):
+	options = np.full((nplayers, nslots), UNSET, dtype=np.int8)
+	assignment = np.full(nplayers, UNSET, dtype=np.int16)
+	payoff = np.full(nplayers, UNSET, dtype=np.int16)
+	decision = np.full(nplayers, UNSET, dtype=np.int8)
+
+	switching = set(json.loads(group.switching or '[]'))
+	remaining = set(json.loads(group.remaining or '[]'))
+	for p in group.get_players():
+		role = p.id_in_group - 1
+		if p.current_slot_machine_id:
+			assignment[role] = json.loads(p.current_slot_machine_id)
+		payoff[role] = _int(p.payoff_current)
+		decision[role] = _int(p.offer_accepted)
+		if role in switching and p.sm_options != "NA":
+			for sm_id, pay_amt in json.loads(p.sm_options).items():
+				options[role, int(sm_id)] = pay_amt
+		elif role in remaining and assignment[role] != UNSET:
+			options[role, assignment[role]] = payoff[role]
+
+	return {'session': session.code, 'round': group.round_number, 'group': group.id_in_subsession,
+	        'super_group': _int(group.super_group), 'alg': ALGS.index(group.alg), 'options': options,
+	        'assignment': assignment, 'payoff': payoff, 'decision': decision, 'switch_probs': switch_probs}
+
+
+# export rows of every round of every group of the sessions, one at a time
+def iter_rounds(sessions, nplayers, nslots):
+	from . import models
+
+	for session in sessions:
+		for subsession in models.Subsession.objects.filter(session=session).order_by('round_number'):
+			switch_probs = subsession.switch_estimator().predict()
+			for group in subsession.get_groups():
+				yield round_row(session, group, switch_probs, nplayers, nslots)
+
+
+def export_sessions(session_codes, directory, chunk_rows=4096):
+	from otree.models import Session
+	from .models import Constants
+
+	sessions = Session.objects.filter(code__in=session_codes).order_by('code').iterator()
+	writer = ColumnarWriter(directory, Constants.players_per_group, Constants.num_sm, chunk_rows)
+	for row in iter_rounds(sessions, Constants.players_per_group, Constants.num_sm):
+		writer.write(row)
+	writer.close()
+	return writer.rows
@@ -0,0 +1,64 @@
+import csv
+import functools
+import json
+import os
+import time
+from collections import deque
+
+# Optional timing of the per-round hot path (Group methods and matching_algorithms entry points).
+# Off unless the MATCHING_METRICS environment variable is set (or enable() is called);
+# when off, an instrumented call costs one global lookup.
+# Records go to the in-process RECORDS registry, and also to the JSON-lines file
+# MATCHING_METRICS_LOG if set; dump_csv() writes the registry out. The registry keeps only the latest
+# MATCHING_METRICS_MAX records (default 100000), so a long instrumented server run does not grow without bound.
+
+ENABLED = os.environ.get('MATCHING_METRICS') not in {None, '', '0'}
+LOG_PATH = os.environ.get('MATCHING_METRICS_LOG')
+
+RECORDS = deque(maxlen=int(os.environ.get('MATCHING_METRICS_MAX', 100000)))
+
+
+def enable(on=True):
+	global ENABLED
+	ENABLED = on
+
+
+def clear():
+	RECORDS.clear()
+
+
+def record(event, **fields):
+	fields['event'] = event
+	RECORDS.append(fields)
+	if LOG_PATH:
+		with open(LOG_PATH, 'a') as log:
+			log.write(json.dumps(fields, default=str) + '\n')
+
+
+# decorator: record the wall time of each call as event, plus the fields returned by
+# describe, which is called after fn with the same arguments (so it can read what fn set)
+def timed(event, describe=None):
+	def decorate(fn):
+		@functools.wraps(fn)
+		def wrapper(*args, **kwargs):
+			if not ENABLED:
+				return fn(*args, **kwargs)
+			start = time.perf_counter()
+			result = fn(*args, **kwargs)
+			wall_ms = (time.perf_counter() - start) * 1000
+			fields = describe(*args, **kwargs) if describe is not None else {}
+			record(event, wall_ms=wall_ms, **fields)
+			return result
+		return wrapper
+	return decorate
+
+
+def dump_csv(path, records=None):
+	records = RECORDS if records is None else records
+	columns = ['event', 'wall_ms']
+	for fields in records:
+		columns.extend(key for key in fields if key not in columns)
+	with open(path, 'w', newline='') as f:
+		writer = csv.DictWriter(f, columns)
+		writer.writeheader()
+		writer.writerows(records)
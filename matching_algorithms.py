@@ -1,82 +1,487 @@
 import numpy as np
-from scipy.optimize import minimize
-from scipy.optimize import linear_sum_assignment
-import matplotlib.pyplot as plt
+import functools
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+from instrumentation import timed
+
+# Importing this module only loads numpy; SciPy (and the process pool machinery) are imported
+# inside the functions that use them, so oTree workers, bots and simulation worker processes
+# do not pay for them until the first matching is solved. benchmarks.py --import-budget-ms
+# checks the import time.
+
+__all__ = [
+	'correlated_payoffs_batch', 'payoff_dicts', 'correlated_payoffs', 'PayoffSource', 'payoff_source',
+	'mask_bits', 'available_options', 'UNAVAILABLE', 'Matrices', 'switch_lookup', 'prob_array',
+	'build_batch_matrices', 'build_matrices', 'payoff_matrix', 'probability_matrix',
+	'SOLVERS', 'register_solver', 'get_solver', 'scipy_solver',
+	'fair_matching', 'self_matching', 'options_biadjacency', 'sparse_matching', 'match_options',
+	'options_fingerprint', 'MatchingCache', 'MATCHING_CACHE', 'batch_matching', 'maxmin_matching',
+	'MatchState', 'incremental_assignment', 'incremental_matching', 'normalize_payoff', 'initialize_probs',
+]
+
+# called once to draw every super group's combinations set
+def correlated_payoffs_batch(n_sm, nplayers, ngroups):
+	# n_sm = number of slot machines
+	# Correlated distribution: one base per super group, player noise around it
+	base = np.random.beta(1, 2, size=(ngroups, 1, n_sm))*20
+	p = np.random.normal(0.0, 3.0, size=(ngroups, nplayers, n_sm))
+	pay = normalize_payoff(base + p)
+
+	return np.ascontiguousarray(pay, dtype=np.int64)	# (ngroups, nplayers, n_sm) array
+
+
+# dict view of one super group's payoff table: list of nplayers dicts sm_id --> pay_amt
+def payoff_dicts(table):
+	return [dict(enumerate(row.tolist())) for row in table]
+
 
 # called to initialize for each super group's combinations set
 def correlated_payoffs(n_sm, nplayers):
-	# n = number of slot machines
-	# Correlated distribution
-	payoffs = []
-	
-	base = np.random.beta(1, 2, size=n_sm)*20 
+	return payoff_dicts(correlated_payoffs_batch(n_sm, nplayers, 1)[0])	# list with nplayers number of dictionaries
+
+
+# Seeded payoff stream: a player's row is drawn on demand from its own Generator
+# stream keyed by (seed, super_group, role), so nothing needs storing in session.vars
+class PayoffSource:
+	def __init__(self, seed, n_sm, maxsize=1024):
+		self.seed = seed
+		self.n_sm = n_sm
+		self.maxsize = maxsize
+		self._rows = OrderedDict()		# bounded LRU of materialized rows
+		self._lock = threading.Lock()	# shared by request threads through payoff_source
+
+	def _stream(self, *key):
+		return np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=key))
+
+	def base(self, super_group):
+		return self._stream(super_group, 0).beta(1, 2, size=self.n_sm)*20
+
+	def row(self, super_group, role):
+		key = (super_group, role)
+		with self._lock:
+			if key in self._rows:
+				self._rows.move_to_end(key)
+				return self._rows[key]
+
+		p = self._stream(super_group, 1, role).normal(0.0, 3.0, size=self.n_sm)
+		pay = normalize_payoff(self.base(super_group) + p).astype(np.int64)
+		pay.flags.writeable = False		# rows are shared between callers
+
+		with self._lock:		# drawn outside the lock: the same key always gives the same row
+			self._rows[key] = pay
+			self._rows.move_to_end(key)
+			if len(self._rows) > self.maxsize:
+				self._rows.popitem(last=False)
+		return pay
+
+	# (len(super_groups), nplayers, n_sm) table, same layout as correlated_payoffs_batch
+	def table(self, super_groups, nplayers):
+		return np.array([[self.row(sg, role) for role in range(nplayers)] for sg in super_groups])
+
+
+# one source per (seed, n_sm) per process, so rows stay cached across requests
+@functools.lru_cache(maxsize=32)
+def payoff_source(seed, n_sm):
+	return PayoffSource(seed, n_sm)
+
+
+# Availability bitmasks (plain ints): bit j set <=> slot machine j is taken
+def mask_bits(mask, nslots):
+	packed = np.frombuffer(mask.to_bytes((nslots + 7) // 8, 'little'), dtype=np.uint8)
+	return np.unpackbits(packed, bitorder='little')[:nslots].astype(bool)
+
+
+# partial dictionary sm_id --> pay_amt of the slots of a payoff row not taken in the bitmask
+def available_options(row, taken, nslots):
+	free = ~mask_bits(taken, nslots)
+	return dict(zip(np.flatnonzero(free).tolist(), np.asarray(row)[free].tolist()))
+
+
+UNAVAILABLE = -10000.0		# weight of slots a player cannot be matched with
+
+# payoff matrix, availability mask and probability matrix (if prob is given) of one round
+Matrices = namedtuple('Matrices', ['payoff', 'mask', 'prob'])
+
 
-	for i in range(nplayers):		# changed indexing here
-		sm_d = {}
-		p = np.random.normal(0.0, 3.0, size=n_sm)
-		pay = base + p
-		pay = normalize_payoff(pay)
+# prob = dictionary (or 21-entry array) with probability of switching as a function of payoff
+# returns the 21-entry lookup array prob/(1 + prob) indexed by payoff
+def switch_lookup(prob):
+	prob = prob_array(prob)
+	return prob / (1 + prob)
 
-		for j in range(n_sm):
-			sm_d[j]=pay[j]
-		payoffs.append(sm_d)
 
-	return payoffs	# list with nplayers number of dictionaries
+def prob_array(prob):
+	if isinstance(prob, dict):
+		prob = [prob[i] for i in range(21)]
+	return np.asarray(prob, dtype=float)
+
+
+# Stacked matrices of one round for many groups, built in a single vectorized pass
+# options = list of per-group partial dictionaries with payoffs, qs = per-group prob (None for fair groups)
+# payoff, mask and prob are (ngroups, nplayers, nslots); prob is None if no group has a prob
+@timed('build_matrices', lambda options, nslots, nplayers, qs=None: dict(groups=len(options), nplayers=nplayers, nslots=nslots))
+def build_batch_matrices(options, nslots, nplayers, qs=None):
+	g_ids, rows, cols, pays = [], [], [], []
+	for g, payoffs in enumerate(options):
+		for p_id, sm_pay_dict in payoffs.items():
+			if p_id < nplayers:
+				g_ids.extend([g] * len(sm_pay_dict))
+				rows.extend([p_id] * len(sm_pay_dict))
+				cols.extend(sm_pay_dict.keys())
+				pays.extend(sm_pay_dict.values())
+
+	payoff = np.full((len(options), nplayers, nslots), UNAVAILABLE)	# assign negative weight to unavailable slots
+	mask = np.zeros((len(options), nplayers, nslots), dtype=bool)
+	payoff[g_ids, rows, cols] = pays
+	mask[g_ids, rows, cols] = True
+
+	prob_mat = None
+	if qs is not None and any(q is not None for q in qs):
+		lookup = np.array([np.full(21, UNAVAILABLE) if q is None else switch_lookup(q) for q in qs])
+		prob_mat = np.full(payoff.shape, UNAVAILABLE)
+		prob_mat[mask] = lookup[np.nonzero(mask)[0], payoff[mask].astype(np.int64)]
+
+	return Matrices(payoff, mask, prob_mat)
 
 
  # Input: partial dictionary with payoffs
  # nslots = slot machines per user
+def build_matrices(payoffs, nslots, nplayers, prob=None):
+	payoff, mask, prob_mat = build_batch_matrices([payoffs], nslots, nplayers, [prob])
+	return Matrices(payoff[0], mask[0], None if prob_mat is None else prob_mat[0])
+
+
+# instrumentation fields of a matching call
+def _call_fields(payoffs, nslots, nplayers, solver):
+	return dict(nplayers=nplayers, nslots=nslots, options=sum(len(o) for o in payoffs.values()), solver=solver)
+
+
 def payoff_matrix(payoffs, nslots, nplayers):
-	matrix = []
-	for p_id in range(nplayers):
-		p = [-10000.0 for i in range(nslots)] # assign negative weight to unavailable slots
-		if p_id in payoffs.keys():
-			sm_pay_dict = payoffs[p_id]
-			for sm_id in sm_pay_dict.keys():
-				p[sm_id] = sm_pay_dict[sm_id]
-		matrix.append(p)
-	return np.array(matrix)		
+	return build_matrices(payoffs, nslots, nplayers).payoff
+
+
+# Max-weight assignment backends, selectable by name: solver(weight) --> row_ind, col_ind
+SOLVERS = {}
+
+
+def register_solver(name):
+	def register(solver):
+		SOLVERS[name] = solver
+		return solver
+	return register
+
+
+def get_solver(name):
+	if name not in SOLVERS:
+		raise ValueError("unknown matching solver %r, expected one of %r" % (name, sorted(SOLVERS)))
+	return SOLVERS[name]
+
+
+@register_solver('scipy')
+def scipy_solver(weight):
+	from scipy.optimize import linear_sum_assignment
+	return linear_sum_assignment(-1*weight)
 
 
 # Fair matching assignation	
-def fair_matching(payoffs, nslots, nplayers):
-	payoff = payoff_matrix(payoffs, nslots, nplayers)
-	cost = -1*payoff
-	row_ind, col_ind = linear_sum_assignment(cost)
-	pays = []
-	for i in range(len(row_ind)):
-		pays.append(payoff[row_ind[i], col_ind[i]])
-		
-	return row_ind, col_ind, pays
+@timed('fair_matching', lambda payoffs, nslots, nplayers, matrices=None, solver='scipy': _call_fields(payoffs, nslots, nplayers, solver))
+def fair_matching(payoffs, nslots, nplayers, matrices=None, solver='scipy'):
+	if solver == 'sparse':
+		return sparse_matching(payoffs, nslots, nplayers)
+	if matrices is None:
+		matrices = build_matrices(payoffs, nslots, nplayers)
+	payoff = matrices.payoff
+	row_ind, col_ind = get_solver(solver)(payoff)
 
+	return row_ind, col_ind, payoff[row_ind, col_ind].tolist()
 
 
-# prob = dictionary with probability of switching as a function of payoff
 def probability_matrix(payoffs, nslots, nplayers, prob):
-	payoff_mat = payoff_matrix(payoffs, nslots, nplayers)
-
-	matrix = [[-10000.0 for i in range(nslots)] for i in range(nplayers)]
-	for i in range(nplayers):
-		for j in range(nslots):
-			p = payoff_mat[i][j]
-			if p >=0:
-				matrix[i][j]= prob[p]/ (1 + prob[p])
-	return np.array(matrix)
+	return build_matrices(payoffs, nslots, nplayers, prob).prob
 
 
 # Selfish Matching assignation
-def self_matching(payoffs, nslots, nplayers, q):
-	prob = probability_matrix(payoffs, nslots, nplayers, q)
-	payoff = payoff_matrix(payoffs, nslots, nplayers)
-	null_prob = -1*prob
-	player_ind, sm_ind = linear_sum_assignment(null_prob)
-
-	pays = []
-	for i in range(len(player_ind)):
-		pays.append(payoff[player_ind[i], sm_ind[i]])
-	
-	return player_ind, sm_ind, pays
-
+@timed('self_matching', lambda payoffs, nslots, nplayers, q, matrices=None, solver='scipy': _call_fields(payoffs, nslots, nplayers, solver))
+def self_matching(payoffs, nslots, nplayers, q, matrices=None, solver='scipy'):
+	if solver == 'sparse':
+		return sparse_matching(payoffs, nslots, nplayers, q)
+	if matrices is None or matrices.prob is None:
+		matrices = build_matrices(payoffs, nslots, nplayers, q)
+	player_ind, sm_ind = get_solver(solver)(matrices.prob)
+
+	return player_ind, sm_ind, matrices.payoff[player_ind, sm_ind].tolist()
+
+
+# CSR biadjacency (players with options x slots) built straight from the options dicts
+# returns the player ids of the rows, the matrix and the payoff of every stored edge
+def options_biadjacency(payoffs, nslots, nplayers):
+	from scipy.sparse import csr_matrix
+	p_ids = sorted(p_id for p_id in payoffs if p_id < nplayers and payoffs[p_id])
+	indptr = np.zeros(len(p_ids) + 1, dtype=np.int64)
+	indices, pays = [], []
+	for k, p_id in enumerate(p_ids):
+		indices.extend(payoffs[p_id].keys())
+		pays.extend(payoffs[p_id].values())
+		indptr[k + 1] = len(indices)
+
+	pays = np.array(pays, dtype=float)
+	biadjacency = csr_matrix((np.ones(len(pays)), np.array(indices, dtype=np.int64), indptr), shape=(len(p_ids), nslots))
+	return np.array(p_ids, dtype=np.int64), biadjacency, pays
+
+
+# Sparse matching: max weight full matching of the players with options, without dense matrices
+# weights are payoffs (q=None, fair) or switching probabilities (q given, self)
+# falls back to the dense solve when no matching covers every such player
+@timed('sparse_matching', lambda payoffs, nslots, nplayers, q=None: _call_fields(payoffs, nslots, nplayers, 'sparse'))
+def sparse_matching(payoffs, nslots, nplayers, q=None):
+	from scipy.sparse import csr_matrix
+	from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+	p_ids, biadjacency, pays = options_biadjacency(payoffs, nslots, nplayers)
+	if len(p_ids) == 0:
+		return p_ids, p_ids.copy(), []
+
+	weight = pays if q is None else switch_lookup(q)[pays.astype(np.int64)]
+	biadjacency.data = weight.max() + 1 - weight		# strictly positive, so no edge reads as missing
+	try:
+		row_ind, col_ind = min_weight_full_bipartite_matching(biadjacency)
+	except ValueError:
+		if q is None:
+			return fair_matching(payoffs, nslots, nplayers)
+		return self_matching(payoffs, nslots, nplayers, q)
+
+	pay_amts = csr_matrix((pays, biadjacency.indices, biadjacency.indptr), shape=biadjacency.shape)[row_ind, col_ind]
+	return p_ids[row_ind], col_ind, np.asarray(pay_amts).ravel().tolist()
+
+
+# One group's matching from its options alone, as Group.match_pay: alg = 'fair', 'self' (needs prob) or 'maxmin'
+def match_options(payoffs, nslots, nplayers, prob=None, solver='scipy', alg='fair'):
+	if alg == 'maxmin':
+		return maxmin_matching(payoffs, nslots, nplayers)
+	if prob is None:
+		return fair_matching(payoffs, nslots, nplayers, solver=solver)
+	return self_matching(payoffs, nslots, nplayers, prob, solver=solver)
+
+
+# hash of everything a matching depends on: options, switching probabilities, solver and algorithm
+def options_fingerprint(payoffs, prob=None, solver='scipy', alg='fair'):
+	digest = hashlib.sha1()
+	for p_id in sorted(payoffs):
+		digest.update(repr((int(p_id), sorted((int(sm_id), float(pay)) for sm_id, pay in payoffs[p_id].items()))).encode())
+	digest.update(repr((None if prob is None else prob_array(prob).tolist(), solver, alg)).encode())
+	return digest.hexdigest()
+
+
+# Bounded LRU of solved matchings keyed by (nslots, nplayers, options_fingerprint):
+# filled speculatively for likely decision profiles, and dedupes identical subproblems in simulations
+class MatchingCache:
+	def __init__(self, maxsize=512):
+		self.maxsize = maxsize
+		self.hits = self.misses = 0
+		self._results = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		with self._lock:
+			if key in self._results:
+				self._results.move_to_end(key)
+				self.hits += 1
+				return self._results[key]
+			self.misses += 1
+			return None
+
+	def put(self, key, result):
+		with self._lock:
+			self._results[key] = result
+			self._results.move_to_end(key)
+			if len(self._results) > self.maxsize:
+				self._results.popitem(last=False)
+
+	# the cached match_options of this problem, None if it was not solved before
+	def lookup(self, payoffs, nslots, nplayers, prob=None, solver='scipy', alg='fair'):
+		return self.get((nslots, nplayers, options_fingerprint(payoffs, prob, solver, alg)))
+
+	# match_options, from the cache when the same problem was solved before
+	def solve(self, payoffs, nslots, nplayers, prob=None, solver='scipy', alg='fair'):
+		key = (nslots, nplayers, options_fingerprint(payoffs, prob, solver, alg))
+		result = self.get(key)
+		if result is None:
+			result = match_options(payoffs, nslots, nplayers, prob, solver, alg)
+			self.put(key, result)
+		return result
+
+
+MATCHING_CACHE = MatchingCache()		# shared by the whole process
+
+
+def _solve_problem(payoff, prob, solver):
+	row_ind, col_ind = get_solver(solver)(payoff if prob is None else prob)
+	return row_ind, col_ind, payoff[row_ind, col_ind].tolist()
+
+
+# worker pool kept for the life of the process, so batches do not pay for process start-up
+@functools.lru_cache(maxsize=4)
+def _worker_pool(workers):
+	from concurrent.futures import ProcessPoolExecutor
+	return ProcessPoolExecutor(workers)
+
+
+# Batched matching of every group of a round: options = list of per-group partial dictionaries,
+# qs = per-group switching probabilities (None for fair groups), algs = per-group algorithm
+# ('fair', 'self' or 'maxmin'; by default read off qs)
+# matrices are built for all groups at once, then solved in-process or fanned out to workers processes
+# returns one (p_ids, sm_ids, pay_amts) per group, as fair_matching / self_matching
+@timed('batch_matching', lambda options, nslots, nplayers, qs=None, solver='scipy', workers=None, algs=None: dict(groups=len(options), nplayers=nplayers, nslots=nslots, solver=solver))
+def batch_matching(options, nslots, nplayers, qs=None, solver='scipy', workers=None, algs=None):
+	if qs is None:
+		qs = [None] * len(options)
+	if algs is None:
+		algs = ['fair' if q is None else 'self' for q in qs]
+	if solver == 'sparse':
+		return [match_options(payoffs, nslots, nplayers, q, solver, alg) for payoffs, q, alg in zip(options, qs, algs)]
+
+	matrices = build_batch_matrices(options, nslots, nplayers, qs)
+	probs = [None if q is None else matrices.prob[g] for g, q in enumerate(qs)]
+	results = [None] * len(options)
+	assignment = [g for g, alg in enumerate(algs) if alg != 'maxmin']
+	if workers and workers > 1:
+		solved = _worker_pool(workers).map(_solve_problem, [matrices.payoff[g] for g in assignment], [probs[g] for g in assignment], [solver] * len(assignment))
+	else:
+		solved = [_solve_problem(matrices.payoff[g], probs[g], solver) for g in assignment]
+	for g, result in zip(assignment, solved):
+		results[g] = result
+
+	for g, alg in enumerate(algs):
+		if alg == 'maxmin':
+			results[g] = maxmin_matching(options[g], nslots, nplayers, Matrices(matrices.payoff[g], matrices.mask[g], None))
+	return results
+
+
+# Bottleneck (max-min) fair matching: maximize the lowest payoff of the players with options,
+# then the total payoff among the matchings that reach it
+# binary search over the (at most 21) payoff levels, each a Hopcroft-Karp feasibility check
+# falls back to fair_matching when no matching covers every player with options
+@timed('maxmin_matching', lambda payoffs, nslots, nplayers, matrices=None: _call_fields(payoffs, nslots, nplayers, 'hopcroft-karp'))
+def maxmin_matching(payoffs, nslots, nplayers, matrices=None):
+	from scipy.sparse import csr_matrix
+	from scipy.sparse.csgraph import maximum_bipartite_matching
+	if matrices is None:
+		matrices = build_matrices(payoffs, nslots, nplayers)
+	payoff, mask = matrices.payoff, matrices.mask
+	rows = np.flatnonzero(mask.any(axis=1))
+
+	def covers(threshold):
+		graph = csr_matrix(mask[rows] & (payoff[rows] >= threshold))
+		return bool(np.all(maximum_bipartite_matching(graph, perm_type='column') >= 0))
+
+	levels = np.unique(payoff[mask])
+	if len(rows) == 0 or not covers(levels[0]):
+		return fair_matching(payoffs, nslots, nplayers, matrices)
+
+	lo, hi = 0, len(levels) - 1		# covers(levels[lo]) always holds
+	while lo < hi:
+		mid = (lo + hi + 1) // 2
+		if covers(levels[mid]):
+			lo = mid
+		else:
+			hi = mid - 1
+
+	# max-sum tie-break on the cells at or above the bottleneck
+	above = np.where(mask & (payoff >= levels[lo]), payoff, UNAVAILABLE)
+	row_ind, col_ind = scipy_solver(above)
+	return row_ind, col_ind, payoff[row_ind, col_ind].tolist()
+
+
+# Assignment and duals of the last solve, kept between rounds by incremental_matching
+MatchState = namedtuple('MatchState', ['row_to_col', 'u', 'v'])
+
+
+# one Hungarian step: add free row i to the matching along a shortest augmenting path
+# keeps u + v <= cost everywhere, tight on matched cells, and v = 0 on free columns
+def _augment(cost, i, col_to_row, u, v):
+	nslots = cost.shape[1]
+	minv = np.full(nslots, np.inf)
+	way = np.full(nslots, -1)
+	used = np.zeros(nslots, dtype=bool)
+	tree_rows = [i]
+	i0, j0 = i, -1
+
+	while True:
+		free = ~used
+		cur = cost[i0] - u[i0] - v
+		better = free & (cur < minv)
+		minv[better] = cur[better]
+		way[better] = j0
+
+		reach = np.where(free, minv, np.inf)
+		j0 = int(np.argmin(reach))
+		delta = reach[j0]
+		u[tree_rows] += delta
+		v[used] -= delta
+		minv[free] -= delta
+
+		used[j0] = True
+		if col_to_row[j0] == -1:
+			break
+		i0 = col_to_row[j0]
+		tree_rows.append(i0)
+
+	while j0 != -1:		# flip the path back to row i
+		j_prev = way[j0]
+		col_to_row[j0] = i if j_prev == -1 else col_to_row[j_prev]
+		j0 = j_prev
+
+
+# warm start: keep every previous pair that is still tight and dual feasible under the new cost
+def _warm_start(cost, state):
+	row_to_col, u, v = state
+	row_to_col = np.array(row_to_col)
+	v = np.minimum(np.asarray(v, dtype=float), 0.0)
+	rows = np.arange(cost.shape[0])
+	u = np.zeros(cost.shape[0])
+
+	while True:
+		kept = row_to_col >= 0
+		v[np.setdiff1d(np.arange(cost.shape[1]), row_to_col[kept])] = 0.0	# free columns carry no dual
+		u[kept] = cost[rows[kept], row_to_col[kept]] - v[row_to_col[kept]]
+		feasible = np.all(u[:, None] + v[None, :] <= cost + 1e-9, axis=1)
+		stale = kept & ~feasible
+		if not stale.any():
+			return row_to_col, u, v
+		row_to_col[stale] = -1		# re-augment these rows
+
+
+# min cost assignment of every row, re-augmenting only rows the previous state cannot keep
+def incremental_assignment(cost, state=None):
+	nplayers, nslots = cost.shape
+	if state is None:
+		row_to_col, u, v = np.full(nplayers, -1), np.zeros(nplayers), np.zeros(nslots)
+	else:
+		row_to_col, u, v = _warm_start(cost, state)
+
+	col_to_row = np.full(nslots, -1)
+	col_to_row[row_to_col[row_to_col >= 0]] = np.flatnonzero(row_to_col >= 0)
+	for i in np.flatnonzero(row_to_col < 0):
+		_augment(cost, i, col_to_row, u, v)
+
+	row_to_col = np.full(nplayers, -1)
+	row_to_col[col_to_row[col_to_row >= 0]] = np.flatnonzero(col_to_row >= 0)
+	return MatchState(row_to_col, u, v)
+
+
+# Incremental alternative to fair_matching (q=None) and self_matching (q given)
+# state = MatchState returned by the previous round's call (or its fields as lists), None for a cold solve
+@timed('incremental_matching', lambda payoffs, nslots, nplayers, state=None, q=None, matrices=None: _call_fields(payoffs, nslots, nplayers, 'incremental'))
+def incremental_matching(payoffs, nslots, nplayers, state=None, q=None, matrices=None):
+	if matrices is None or (q is not None and matrices.prob is None):
+		matrices = build_matrices(payoffs, nslots, nplayers, q)
+	weight = matrices.payoff if q is None else matrices.prob
+
+	state = incremental_assignment(-1*weight, state)
+	row_ind = np.arange(nplayers)
+	col_ind = state.row_to_col
+
+	return row_ind, col_ind, matrices.payoff[row_ind, col_ind].tolist(), state
 
 
 def normalize_payoff(p):
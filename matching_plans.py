@@ -0,0 +1,55 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Next-round matchings computed off the request thread.
+# A plan is submitted as soon as a group's decisions are complete and taken when its wait page
+# resolves; it is only used if it was computed from exactly the options the wait page built
+# (same fingerprint), otherwise the caller solves synchronously.
+
+MAX_PLANS = 1000		# plans never taken (e.g. abandoned sessions) are dropped oldest first
+
+_plans = OrderedDict()	# key --> (fingerprint, future)
+_executors = {}
+_lock = threading.Lock()
+
+
+# kind = 'thread' or 'process'; one executor of each kind per process
+def executor(kind='thread', workers=2):
+	with _lock:
+		if kind not in _executors:
+			if kind == 'process':
+				_executors[kind] = ProcessPoolExecutor(workers)
+			elif kind == 'thread':
+				_executors[kind] = ThreadPoolExecutor(workers)
+			else:
+				raise ValueError("unknown executor kind %r" % (kind,))
+		return _executors[kind]
+
+
+def submit_plan(key, fingerprint, kind, fn, *args):
+	future = executor(kind).submit(fn, *args)
+	with _lock:
+		replaced = _plans.pop(key, None)		# planned again, from newer decisions
+		if replaced is not None:
+			replaced[1].cancel()
+		_plans[key] = (fingerprint, future)
+		while len(_plans) > MAX_PLANS:
+			_plans.popitem(last=False)[1][1].cancel()
+	return future
+
+
+# result of the plan for key if it matches fingerprint and finishes within timeout seconds, else None
+def take_plan(key, fingerprint, timeout=None):
+	with _lock:
+		plan = _plans.pop(key, None)
+	if plan is None:
+		return None
+	planned_fingerprint, future = plan
+	if planned_fingerprint != fingerprint:
+		future.cancel()
+		return None
+	try:
+		return future.result(timeout)
+	except Exception:		# timed out or failed: fall back to solving on the request thread
+		return None
@@ -1,6 +1,9 @@
 import otree.api
-import random, numpy, itertools, json, copy
+import random, numpy, itertools, json, collections
 from matching_algorithms import *
+from switching_stats import SwitchEstimator
+from instrumentation import timed
+from matching_plans import executor, submit_plan, take_plan
 
 
 author = 'Ciara Mulcahy'
@@ -12,6 +15,55 @@ remain at the same slot machine, switch slot machines, or quit the game entirely
 """
 
 
+# instrumentation fields of a Group method call, see instrumentation.timed
+def group_fields(group, *args):
+    return dict(session=group.session.code, round=group.round_number, group=group.id_in_subsession,
+                alg=group.alg, switching=len(json.loads(group.switching or '[]')))
+
+
+# plain state of a group's active players, which next round's options and probabilities are planned from
+# (so that speculative solves can plan off the request thread)
+Seat = collections.namedtuple('Seat', ['id_in_group', 'role', 'slot_machine', 'payoff', 'visited'])
+
+
+def active_seats(players):
+    return [Seat(p.id_in_group, p.participant.vars['role'], p.participant.vars.get('slotMachineCurrent'),
+                 p.payoff_current, p.participant.vars['slotMachinesPrev'])
+            for p in players if p.participant.vars['statusActive']]
+
+
+# (payoffs, switched) the switching estimator learns from a round's decisions = {id_in_group: offer_accepted}:
+# each active player who decided, their payoff and whether they switched away from it
+def decision_observations(seats, decisions):
+    observed = [seat for seat in seats if decisions[seat.id_in_group] is not None]
+    return [seat.payoff for seat in observed], [decisions[seat.id_in_group] == 2 for seat in observed]
+
+
+# options next round's make_options will build if the seats decide as decisions, given the group's
+# occupied bitmask and payoff rows (payoffs = PayoffSource, rows of super_group)
+def planned_options(seats, decisions, occupied, payoffs, super_group):
+    for seat in seats:
+        if decisions[seat.id_in_group] in (2, 3):  # switch or quit: sm no longer occupied
+            occupied &= ~(1 << seat.slot_machine)
+
+    opts = {}
+    for seat in seats:
+        if decisions[seat.id_in_group] == 2:
+            opts[seat.role] = available_options(payoffs.row(super_group, seat.role), occupied | seat.visited, Constants.num_sm)
+        elif decisions[seat.id_in_group] == 1:
+            opts[seat.role] = {seat.slot_machine: seat.payoff}
+    return opts
+
+
+# session-wide switching probabilities next round if groups decide as profiles = {group index: (seats, decisions)}:
+# their shards updated with them, merged with the other groups' shards
+def planned_probs(shards, profiles):
+    shards = list(shards)
+    for index, (seats, decisions) in profiles.items():
+        shards[index] = shards[index].updated(*decision_observations(seats, decisions))
+    return SwitchEstimator.merge(shards).predict()
+
+
 class Constants(otree.api.BaseConstants):
     name_in_url = 'SlotMachines'
     num_groups = 3      # change this to handle super-grouping
@@ -43,22 +95,13 @@ class Subsession(otree.api.BaseSubsession):
                     p.participant.vars['role'] = p.id_in_group - 1
                     p.role()
 
-            # need to reevaluate this - 0-20 associated with [times switched away from, times accessed] this payout
-
-            # make session-global payoff_dict for selfish alg [times switched away from, times accessed] this payout
-            self.session.vars['payoff_dict'] = {}
-            init_visit_list = [0,0]        # [times switched away from, times accessed] this payout
-            for pay_amt in range(Constants.payout_max + 1):
-                self.session.vars['payoff_dict'][pay_amt] = init_visit_list
-
             # assign payoffs to player role numbers across groups
-            self.session.vars['combinations'] = {}
-            for super_group in range(1, Constants.num_groups + 1):
-                self.session.vars['combinations'][super_group] = correlated_payoffs(Constants.num_sm, Constants.players_per_group)   # new implementation
+            # payoffs are drawn lazily per (super_group, role) from this seed, see PayoffSource
+            self.session.vars['payoff_seed'] = self.session.config.get('payoff_seed', numpy.random.SeedSequence().entropy)
 
             # assign matching algorithm to each group
             groups = self.get_groups()
-            alg = itertools.cycle(['fair', 'self'])
+            alg = itertools.cycle(self.session.config.get('treatments', ['fair', 'self']))   # 'fair', 'self' and/or 'maxmin'
             count = 2
             for g in groups:
                 g.alg = next(alg)
@@ -69,17 +112,21 @@ class Subsession(otree.api.BaseSubsession):
 
                 # initially activate players instances
                 for p in g.get_players():
-                    p.participant.vars['slotMachinesPrev'] = set()
+                    p.participant.vars['slotMachinesPrev'] = 0    # bitmask of sm's already visited
                     p.participant.vars['statusActive'] = True
 
+                g.switch_estimator = SwitchEstimator.from_config(self.session.config).dumps()   # this group's shard of the selfish alg's statistics
                 g.switching = json.dumps(list(range(Constants.players_per_group)))   # all 'switch' 1st round
                 g.remaining = json.dumps([])
-                player_scribe.participant.vars['occupied'] = set()  # no slot machines are occupied yet
+                player_scribe.participant.vars['occupied'] = 0  # bitmask, no slot machines are occupied yet
 
                 # Maybe put initial assignments by the matching alg file right here
                 g.make_options()
                 g.match_pay()
 
+            if self.session.config.get('speculative_matching'):
+                self.speculate()
+
         else:
             self.group_like_round(1)    # keep same grouping
 
@@ -91,6 +138,48 @@ class Subsession(otree.api.BaseSubsession):
 
                 g.super_group = g.in_round(prev_round).super_group
 
+    # session-wide switching probability estimator for the selfish alg: merge of every group's latest shard
+    def switch_estimator(self):
+        return SwitchEstimator.merge(g.latest_switch_estimator() for g in self.get_groups())
+
+    # batch_matching mode: every group's matching for the round in one call, once all groups have arrived
+    @timed('batch_round', lambda subsession: dict(session=subsession.session.code, round=subsession.round_number))
+    def before_next_round(self):
+        groups = self.get_groups()
+        for g in groups:
+            g.record_decisions()
+            g.make_options()
+
+        prob = self.switch_estimator().predict()   # once all groups have recorded their decisions
+        solver = self.session.config.get('matching_solver', 'scipy')
+        options = {g: g.get_player_by_role(0).participant.vars['options'] for g in groups}
+        results = {g: g.prepared_matching(options[g], g.switch_probs(prob), solver) for g in groups}
+
+        if self.session.config.get('incremental_matching'):   # re-augmented one group at a time from its last assignment
+            for g in groups:
+                if g.alg != 'maxmin':
+                    results[g] = g.solve_matching(prob)
+
+        pending = [g for g in groups if results[g] is None]   # the groups no plan was made for, in one call
+        if pending:
+            solved = batch_matching([options[g] for g in pending], Constants.num_sm, Constants.players_per_group,
+                                    [g.switch_probs(prob) for g in pending], solver=solver,
+                                    workers=self.session.config.get('matching_workers'), algs=[g.alg for g in pending])
+            results.update(zip(pending, solved))
+        for g in groups:
+            g.apply_matching(*results[g])
+        if self.session.config.get('speculative_matching'):
+            self.speculate()
+
+    # speculative_matching mode, once every group has its matching and shard for the round
+    def speculate(self):
+        groups = self.get_groups()
+        session_seats = None
+        if self.session.config.get('batch_matching'):   # the batch round merges every group's decisions at once
+            session_seats = {g.id_in_subsession - 1: active_seats(g.get_players()) for g in groups}
+        for g in groups:
+            g.speculate(session_seats)
+
 
 class Group(otree.api.BaseGroup):
     # Group means treatment group(but players are interacting), so fair or selfish matching algorithm applied
@@ -98,36 +187,63 @@ class Group(otree.api.BaseGroup):
     alg = otree.api.models.CharField()
     switching = otree.api.models.CharField()
     remaining = otree.api.models.CharField()
+    switch_estimator = otree.api.models.CharField()      # SwitchEstimator shard, updated with this group's decisions each round
 
+    @timed('group_round', group_fields)
     def before_next_round(self):
+        self.record_decisions()
+        self.make_options()
+        self.match_pay()
+        if self.session.config.get('speculative_matching'):
+            self.speculate()
+
+    # apply last round's remain/switch/quit decisions
+    @timed('record_decisions', group_fields)
+    def record_decisions(self):
         player_scribe = self.get_player_by_role(0)
         occ = player_scribe.participant.vars['occupied']
         prev_round = self.round_number - 1
 
+        group_prev = self.in_round(prev_round)
+        players_prev = {p.id_in_group: p for p in group_prev.get_players()}   # whole group's last round in one query
+
+        # last round's decisions, recorded before quitters are deactivated below
+        estimator = group_prev.latest_switch_estimator()
+        estimator.update(*decision_observations(active_seats(players_prev.values()), {i: p.offer_accepted for i, p in players_prev.items()}))
+
         this_switch = []
         this_remain = []
         for p in self.get_players():
-            p.mean_payoff_current = p.participant.vars['meanPayoutCurrent']
+            p_prev = players_prev[p.id_in_group]
             if p.participant.vars['statusActive']:
-                if p.in_round(prev_round).offer_accepted == 3:  # quit
+                if p_prev.offer_accepted == 3:  # quit
                     p.participant.vars['statusActive'] = False
-                    occ.remove(p.participant.vars['slotMachineCurrent'])  # sm no longer occupied
+                    occ &= ~(1 << p.participant.vars['slotMachineCurrent'])  # sm no longer occupied
                     p.participant.payoff += p.quit_payoff()
 
-                elif p.in_round(prev_round).offer_accepted == 2:  # switch
-                    occ.remove(p.participant.vars['slotMachineCurrent'])   # sm no longer occupied
-                    this_switch.append(p.id_in_group)
-                    self.session.vars['payoff_dict'][p.mean_payoff_current][0] += 1   # switching from
+                elif p_prev.offer_accepted == 2:  # switch
+                    occ &= ~(1 << p.participant.vars['slotMachineCurrent'])   # sm no longer occupied
+                    this_switch.append(p.participant.vars['role'])
 
-                elif p.in_round(prev_round).offer_accepted == 1:  # remain
-                    this_remain.append(p.id_in_group)
+                elif p_prev.offer_accepted == 1:  # remain
+                    this_remain.append(p.participant.vars['role'])
                     p.current_slot_machine_id = json.dumps(p.participant.vars['slotMachineCurrent'])
+                    p.payoff_current = p_prev.payoff_current
 
+        player_scribe.participant.vars['occupied'] = occ
+        self.switch_estimator = estimator.dumps()
         self.switching = json.dumps(this_switch)
         self.remaining = json.dumps(this_remain)
-        self.make_options()
-        self.match_pay()
 
+    # this group's shard as of this round: its own, or that of the last round that recorded one
+    # (a group whose players all quit stops updating it)
+    def latest_switch_estimator(self):
+        group = self
+        while group.switch_estimator is None and group.round_number > 1:
+            group = group.in_round(group.round_number - 1)
+        return SwitchEstimator.loads(group.switch_estimator, self.session.config)
+
+    @timed('make_options', group_fields)
     def make_options(self):
         player_scribe = self.get_player_by_role(0)
         switching = json.loads(self.switching)
@@ -147,7 +263,7 @@ class Group(otree.api.BaseGroup):
             '''
 
         for p_id in remaining:
-            p = self.get_player_by_id(p_id)
+            p = self.get_player_by_role(p_id)
             sm_current = json.loads(p.current_slot_machine_id)
             temp_dict = {sm_current: p.payoff_current}
             opts[p_id] = temp_dict
@@ -156,48 +272,184 @@ class Group(otree.api.BaseGroup):
 
 
     def match_pay(self):
-        player_scribe = self.get_player_by_role(0)
-        groups_occupied = player_scribe.participant.vars['occupied']
+        self.apply_matching(*self.solve_matching())
+
+    def plan_key(self):
+        return self.session.code, self.round_number, self.id_in_subsession
+
+    # this round's decisions, {id_in_group: offer_accepted}
+    def decisions(self):
+        return {p.id_in_group: p.offer_accepted for p in self.get_players()}
+
+    def decided(self):
+        return not any(p.participant.vars['statusActive'] and p.offer_accepted is None for p in self.get_players())
+
+    # options next round's make_options will build from this round's decisions, without changing any state
+    def plan_options(self):
+        return planned_options(active_seats(self.get_players()), self.decisions(), self.get_player_by_role(0).participant.vars['occupied'],
+                               payoff_source(self.session.vars['payoff_seed'], Constants.num_sm), self.super_group)
+
+    # async_matching mode: once every active player has decided, solve next round's matching
+    # on an executor; the next round's wait page (solve_matching, or the batch round) uses it if its
+    # options turn out the same
+    def plan_next_round(self):
+        if self.round_number >= Constants.num_rounds or not self.decided():
+            return
+        if not self.session.config.get('batch_matching'):
+            self.submit_next_round(self.planned_switch_probs())
+            return
+
+        # the batch round's probabilities merge every group's decisions: each group that decides plans again
+        # the 'self' groups that decided before it, so that once the last group has decided every plan is current
+        groups = self.subsession.get_groups()
+        planned = [g for g in groups if g == self or (g.alg == 'self' and g.decided())]
+        prob = None
+        if any(g.alg == 'self' for g in planned):
+            prob = planned_probs(self.next_round_shards(),
+                                 {g.id_in_subsession - 1: (active_seats(g.get_players()), g.decisions()) for g in groups})
+        for g in planned:
+            g.submit_next_round(g.switch_probs(prob))
+
+    # plan next round's matching from this round's decisions, with switching probabilities prob
+    def submit_next_round(self, prob):
+        group_next = self.in_round(self.round_number + 1)
+        options = self.plan_options()
+        solver = self.session.config.get('matching_solver', 'scipy')
+        kind = self.session.config.get('async_matching')
+        submit_plan(group_next.plan_key(), options_fingerprint(options, prob, solver, self.alg), 'thread' if kind is True else kind,
+                    match_options, options, Constants.num_sm, Constants.players_per_group, prob, solver, self.alg)
+
+    # speculative_matching mode: while players are still choosing, fill MATCHING_CACHE with next
+    # round's matchings for the likely profiles "everyone remains" and "everyone switches"
+    # run once per group from the wait page, right after this round's matching, not on page renders;
+    # the wait page only reads the group's state, options and probabilities are planned on the executor
+    # session_seats = {group index: active seats} of the groups assumed to make the same choice (default: this one)
+    def speculate(self, session_seats=None):
+        if self.round_number >= Constants.num_rounds:
+            return
+
+        seats = active_seats(self.get_players())
+        shards = None
+        if self.alg == 'self':
+            shards = self.next_round_shards()
+            session_seats = session_seats or {self.id_in_subsession - 1: seats}
+        occupied = self.get_player_by_role(0).participant.vars['occupied']
+        payoffs = payoff_source(self.session.vars['payoff_seed'], Constants.num_sm)
+        super_group, alg = self.super_group, self.alg
+        solver = self.session.config.get('matching_solver', 'scipy')
+
+        def solve(choice):
+            decisions = {seat.id_in_group: choice for seat in seats}
+            options = planned_options(seats, decisions, occupied, payoffs, super_group)
+            prob = None
+            if shards is not None:
+                prob = planned_probs(shards, {index: (group_seats, {seat.id_in_group: choice for seat in group_seats})
+                                              for index, group_seats in session_seats.items()})
+            MATCHING_CACHE.solve(options, Constants.num_sm, Constants.players_per_group, prob, solver, alg)
+
+        for choice in (1, 2):
+            executor('thread').submit(solve, choice)
+
+    # every group's latest shard as next round's wait page will merge them
+    def next_round_shards(self):
+        try:
+            groups = self.in_round(self.round_number + 1).subsession.get_groups()
+        except Group.DoesNotExist:   # creating_session: next round's groups would only read this round's shards
+            groups = self.subsession.get_groups()
+        return [g.latest_switch_estimator() for g in groups]
+
+    # switch_probs() next round's wait page will compute if this round's decisions turn out as made:
+    # this group's shard updated with them, merged with the other groups' latest shards
+    def planned_switch_probs(self):
+        if self.alg in ('fair', 'maxmin'):
+            return None
+        return planned_probs(self.next_round_shards(), {self.id_in_subsession - 1: (active_seats(self.get_players()), self.decisions())})
+
+    # 21-entry array of switching probabilities per payout for the selfish algorithm, None for the others
+    # prob = the session-wide estimate, when the caller already has it
+    def switch_probs(self, prob=None):
+        if self.alg in ('fair', 'maxmin'):
+            return None
+        elif self.alg != 'self':
+            raise ValueError()
 
-        if self.alg == 'fair':
-            p_ids, sm_ids, pay_amts = fair_matching(player_scribe.participant.vars['options'], Constants.num_sm, Constants.players_per_group)    # p_ids not necessary
-
-        elif self.alg == 'self':
-            prob = copy.deepcopy(self.session.vars['payoff_dict'])
-            defaults = initialize_probs()
-            for key in prob:    # replace list with probabilities
-                if prob[key][-1] != 0:
-                    prob[key] = (defaults[key] * 5 + (prob[key][0]/prob[key][-1])* prob[key][-1])/(5 + prob[key][-1])    # factor in the initial pseudoprobs by weighting
-                else:
-                    prob[key] = defaults[key]
-            p_ids, sm_ids, pay_amts = self_matching(player_scribe.participant.vars['options'], Constants.num_sm, Constants.players_per_group, prob)
+        return self.subsession.switch_estimator().predict() if prob is None else prob
+
+    # this round's matching if it was solved ahead for exactly these options (and probabilities), else None:
+    # the async_matching plan, or the speculative_matching solve in MATCHING_CACHE
+    def prepared_matching(self, options, prob, solver):
+        if self.session.config.get('incremental_matching'):
+            return None
+        prepared = None
+        if self.session.config.get('async_matching'):
+            prepared = take_plan(self.plan_key(), options_fingerprint(options, prob, solver, self.alg),
+                                 self.session.config.get('async_matching_timeout', 5))
+        if prepared is None and self.session.config.get('speculative_matching'):
+            prepared = MATCHING_CACHE.lookup(options, Constants.num_sm, Constants.players_per_group, prob, solver, self.alg)
+        return prepared
+
+    # prob = the session-wide switching probabilities, when the caller already has them
+    @timed('solve_matching', group_fields)
+    def solve_matching(self, prob=None):
+        player_scribe = self.get_player_by_role(0)
+        options = player_scribe.participant.vars['options']
+        prob = self.switch_probs(prob)
+
+        solver = self.session.config.get('matching_solver', 'scipy')
+        prepared = self.prepared_matching(options, prob, solver)
+        if prepared is not None:
+            return prepared
+
+        matrices = None
+        if solver != 'sparse':   # the sparse solver works from the options dicts directly
+            matrices = build_matrices(options, Constants.num_sm, Constants.players_per_group, prob)   # payoff (and probability) matrices in one pass
+
+        if self.session.config.get('incremental_matching') and self.alg != 'maxmin':   # opt-in: re-augment from last round's assignment and duals
+            p_ids, sm_ids, pay_amts, state = incremental_matching(
+                options, Constants.num_sm, Constants.players_per_group, player_scribe.participant.vars.get('match_state'), prob, matrices)
+            player_scribe.participant.vars['match_state'] = [field.tolist() for field in state]   # participant.vars is stored as JSON
+        elif self.alg == 'maxmin':   # max-min fair, solver setting does not apply
+            p_ids, sm_ids, pay_amts = maxmin_matching(options, Constants.num_sm, Constants.players_per_group, matrices)
+        elif self.alg == 'fair':
+            p_ids, sm_ids, pay_amts = fair_matching(options, Constants.num_sm, Constants.players_per_group, matrices, solver)    # p_ids not necessary
         else:
-            raise ValueError()
+            p_ids, sm_ids, pay_amts = self_matching(options, Constants.num_sm, Constants.players_per_group, prob, matrices, solver)
+        return p_ids, sm_ids, pay_amts
+
+    @timed('apply_matching', group_fields)
+    def apply_matching(self, p_ids, sm_ids, pay_amts):
+        player_scribe = self.get_player_by_role(0)
+        groups_occupied = player_scribe.participant.vars['occupied']
 
         # raise ValueError("Just checking %r" % (pay_amts))
 
         for i in range(len(sm_ids)):
             player = self.get_player_by_role(p_ids[i])  # only look at active players
             if player.participant.vars['statusActive']:
-                slot_mach_id = sm_ids[i]
+                slot_mach_id = int(sm_ids[i])
                 player.participant.vars['slotMachineCurrent'] = slot_mach_id
-                player.current_slot_machine_id = json.dumps(int(slot_mach_id))
+                player.current_slot_machine_id = json.dumps(slot_mach_id)
 
                 player.payoff_current = pay_amts[i]
 
-                self.session.vars['payoff_dict'][pay_amts[i]][-1] += 1  # update times accessed in payoff_dict
-
-                groups_occupied.add(slot_mach_id)  # note that sm is now occupied
-                player.participant.vars['slotMachinesPrev'].add(slot_mach_id)  # note that player cannot return to this sm
+                groups_occupied |= 1 << slot_mach_id  # note that sm is now occupied
+                player.participant.vars['slotMachinesPrev'] |= 1 << slot_mach_id  # note that player cannot return to this sm
 
                 # payout the payoffs
                 player.payoff = pay_amts[i]
+                player.participant.vars['balance'] = player.participant.vars.get('balance', 0) + pay_amts[i]
+
+        player_scribe.participant.vars['occupied'] = groups_occupied
+
+        for p in self.get_players():
+            p.balance = p.participant.vars.get('balance', 0)   # running total of payoffs, no need to read past rounds
 
 
 
 class Player(otree.api.BasePlayer):
     current_slot_machine_id = otree.api.models.CharField()
     payoff_current = otree.api.models.IntegerField()
+    balance = otree.api.models.CurrencyField()       # sum of payoffs up to this round
 
     def role(self):
         if self.round_number == 1:
@@ -215,21 +467,19 @@ class Player(otree.api.BasePlayer):
             [3, 'Quit this game'],
         ], widget=otree.api.widgets.RadioSelect()
     )
-    # record the slot machine ids with which the player has matched as self.participant.vars['slotMachinesPrev']
+    # record the slot machine ids with which the player has matched as the bitmask self.participant.vars['slotMachinesPrev']
+
+    # dict sm --> pay_amt of the slot machines the player can switch to, given the group's occupied bitmask
+    def payoff_options(self, occupied):
+        taken = occupied | self.participant.vars['slotMachinesPrev']   # occupied or previous sm's
+        p_id = self.participant.vars['role']
+        payoffs = payoff_source(self.session.vars['payoff_seed'], Constants.num_sm)
+        return available_options(payoffs.row(self.group.super_group, p_id), taken, Constants.num_sm)
 
     # make payout dictionary of the player - algorithm file may make this inappropriate
     def make_payoff_dict(self):
         player_scribe = self.group.get_player_by_role(0)
-        groups_occupied = player_scribe.participant.vars['occupied']
-        p_id = self.participant.vars['role']
-        poten_combos = copy.deepcopy(self.session.vars['combinations'][self.group.super_group][p_id])   # indexing the correlated payoffs list, returns a dict sm --> pay_amt
-
-        prev_slot_mach = self.participant.vars['slotMachinesPrev']
-        sm_id_options = list(poten_combos.keys())
-        for sm_id in sm_id_options:
-            if sm_id in groups_occupied or sm_id in prev_slot_mach:  # check for occupied or previous sm's
-                del poten_combos[sm_id]
-                continue
+        poten_combos = self.payoff_options(player_scribe.participant.vars['occupied'])
 
         # associate payouts with player p at different slot machine options
         self.participant.vars['payouts'] = poten_combos
@@ -134,6 +134,13 @@ SESSION_CONFIGS = [
         'num_demo_participants': 8,
         'app_sequence': ['matchingAlg'],
     },
+    {
+        'name' : 'matchingAlgBatch',
+        'display_name': 'Slot Machines (all groups matched at once)',
+        'num_demo_participants': 12,
+        'app_sequence': ['matchingAlg'],
+        'batch_matching': True,
+    },
 ]
 
 # anything you put after the below line will override
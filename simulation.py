@@ -0,0 +1,168 @@
+import itertools
+from collections import namedtuple
+
+import numpy as np
+
+from matching_algorithms import MATCHING_CACHE, PayoffSource, available_options, batch_matching
+from switching_stats import PSEUDO_COUNT, SwitchEstimator
+
+# Headless version of the game's round mechanics (Subsession.creating_session,
+# Group.before_next_round / make_options / match_pay) that runs in memory, without oTree
+
+REMAIN, SWITCH, QUIT = 1, 2, 3		# Player.offer_accepted choices
+
+# defaults mirror models.Constants and the session config keys used by the models
+SimConfig = namedtuple('SimConfig', ['num_groups', 'players_per_group', 'num_rounds', 'num_sm',
+                                     'init_quit_pay', 'dec_quit_pay', 'treatments', 'solver',
+                                     'switch_pseudo_count', 'switch_decay'])
+SimConfig.__new__.__defaults__ = (2, 4, 10, 14, 70, 7, ('fair', 'self'), 'scipy', PSEUDO_COUNT, 1.0)
+
+# what a player sees on ResultsOptions when choosing, see observe()
+Observation = namedtuple('Observation', ['round_number', 'payoff_current', 'balance', 'quit_pay', 'rounds_remaining'])
+
+# per session: treatment per group, total payoff per (group, player) and round each player quit in (0 = never)
+SessionResult = namedtuple('SessionResult', ['algs', 'payoffs', 'quit_round'])
+
+
+# Player policies: policy(obs, rng) --> REMAIN, SWITCH or QUIT
+# (module level classes, so they can be sent to worker processes)
+class RandomPolicy:
+	def __init__(self, p_remain=1/3., p_switch=1/3.):
+		self.p = [p_remain, p_switch, 1 - p_remain - p_switch]
+
+	def __call__(self, obs, rng):
+		return int(rng.choice([REMAIN, SWITCH, QUIT], p=self.p))
+
+
+# remain on a good machine, quit when quitting beats staying on the current machine till the end
+class ThresholdPolicy:
+	def __init__(self, remain_at=10):
+		self.remain_at = remain_at
+
+	def __call__(self, obs, rng):
+		if obs.quit_pay > obs.payoff_current * obs.rounds_remaining:
+			return QUIT
+		if obs.payoff_current >= self.remain_at:
+			return REMAIN
+		return SWITCH
+
+
+def quit_payoff(config, round_number):
+	return config.init_quit_pay - (round_number - 1) * config.dec_quit_pay
+
+
+# ResultsOptions of round_number: that round's payoff, the balance so far, Player.quit_payoff()
+# and the rounds still to come; used by the simulator and by the bots (tests.py) alike
+def observe(config, round_number, payoff_current, balance):
+	return Observation(round_number, payoff_current, balance, quit_payoff(config, round_number), config.num_rounds - round_number)
+
+
+# one session: seed = int or tuple of ints, drives both the payoffs and the players' choices
+# cache = MatchingCache to solve each group through, deduping subproblems seen before
+def simulate_session(seed, policy, config=SimConfig(), cache=None):
+	ngroups, nplayers, nslots = config.num_groups, config.players_per_group, config.num_sm
+	payoffs = PayoffSource(seed, nslots)
+	rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(1 << 16,)))
+
+	algs = list(itertools.islice(itertools.cycle(config.treatments), ngroups))
+	super_groups = [(count + 2) // 2 for count in range(ngroups)]
+	estimator = SwitchEstimator(pseudo_count=config.switch_pseudo_count, decay=config.switch_decay)
+
+	active = np.ones((ngroups, nplayers), dtype=bool)
+	current = np.zeros((ngroups, nplayers), dtype=np.int64)		# slot machine per player
+	pay_current = np.zeros((ngroups, nplayers), dtype=np.int64)
+	total = np.zeros((ngroups, nplayers))
+	quit_round = np.zeros((ngroups, nplayers), dtype=np.int64)
+	visited = [[0] * nplayers for g in range(ngroups)]		# bitmasks, as slotMachinesPrev
+	occupied = [0] * ngroups
+
+	for round_number in range(1, config.num_rounds + 1):
+		options = []
+		choices = np.zeros((ngroups, nplayers), dtype=np.int64)		# this round's decisions, 0 = none
+		for g in range(ngroups):
+			opts = {}
+			for p_id in range(nplayers):
+				if not active[g, p_id]:
+					continue
+				choice = SWITCH		# all 'switch' 1st round
+				if round_number > 1:		# decided on last round's ResultsOptions
+					choice = policy(observe(config, round_number - 1, int(pay_current[g, p_id]), total[g, p_id]), rng)
+					choices[g, p_id] = choice
+
+				if choice == QUIT:
+					active[g, p_id] = False
+					occupied[g] &= ~(1 << int(current[g, p_id]))
+					total[g, p_id] += quit_payoff(config, round_number)
+					quit_round[g, p_id] = round_number
+				elif choice == SWITCH:
+					if round_number > 1:
+						occupied[g] &= ~(1 << int(current[g, p_id]))
+					opts[p_id] = None		# filled once every leaving machine is free
+				else:
+					opts[p_id] = {int(current[g, p_id]): int(pay_current[g, p_id])}
+
+			for p_id in opts:
+				if opts[p_id] is None:
+					opts[p_id] = available_options(payoffs.row(super_groups[g], p_id), occupied[g] | visited[g][p_id], nslots)
+			options.append(opts)
+
+		decided = choices != 0
+		estimator.update(pay_current[decided], choices[decided] == SWITCH)		# whole round at once
+		qs = [estimator.predict() if alg == 'self' else None for alg in algs]
+		if cache is None:
+			results = batch_matching(options, nslots, nplayers, qs, solver=config.solver, algs=algs)
+		else:
+			results = [cache.solve(opts, nslots, nplayers, q, config.solver, alg) for opts, q, alg in zip(options, qs, algs)]
+
+		for g, (p_ids, sm_ids, pay_amts) in enumerate(results):
+			for p_id, sm_id, pay_amt in zip(p_ids, sm_ids, pay_amts):
+				if not active[g, p_id]:
+					continue
+				sm_id = int(sm_id)
+				current[g, p_id] = sm_id
+				pay_current[g, p_id] = pay_amt
+				occupied[g] |= 1 << sm_id
+				visited[g][p_id] |= 1 << sm_id
+				total[g, p_id] += pay_amt
+
+	return SessionResult(algs, total, quit_round)
+
+
+def _simulate(args):
+	seed, policy, config, cached = args
+	return simulate_session(seed, policy, config, MATCHING_CACHE if cached else None)
+
+
+# n sessions with seeds (seed, 0) ... (seed, n-1), spread over a process pool when workers > 1
+# cached = solve through each process's MATCHING_CACHE
+def run_sessions(n, policy, config=SimConfig(), seed=0, workers=None, cached=False):
+	jobs = [((seed, i), policy, config, cached) for i in range(n)]
+	if not workers or workers <= 1:
+		return [_simulate(job) for job in jobs]
+	from concurrent.futures import ProcessPoolExecutor
+	with ProcessPoolExecutor(workers) as pool:
+		return list(pool.map(_simulate, jobs, chunksize=max(1, n // (workers * 8))))
+
+
+# mean total payoff per player, per treatment
+def summarize(results):
+	per_alg = {}
+	for result in results:
+		for alg, payoffs in zip(result.algs, result.payoffs):
+			per_alg.setdefault(alg, []).append(payoffs)
+	return {alg: float(np.mean(payoffs)) for alg, payoffs in per_alg.items()}
+
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description="Simulate slot machine sessions and compare the matching algorithms")
+	parser.add_argument('-n', type=int, default=1000, help="number of sessions")
+	parser.add_argument('--workers', type=int, default=None)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--remain-at', type=int, default=10, help="ThresholdPolicy payoff to remain at")
+	parser.add_argument('--cached', action='store_true', help="dedupe identical matching subproblems")
+	args = parser.parse_args()
+
+	results = run_sessions(args.n, ThresholdPolicy(args.remain_at), seed=args.seed, workers=args.workers, cached=args.cached)
+	for alg, mean in sorted(summarize(results).items()):
+		print("%s: mean payoff per player %.2f" % (alg, mean))
@@ -0,0 +1,89 @@
+import base64
+import numpy as np
+from matching_algorithms import initialize_probs
+
+PAYOUT_LEVELS = 21		# payouts 0-20
+PSEUDO_COUNT = 5		# default weight of the prior, in observations
+
+# default initial pseudo-probabilities of switching away from each payout, computed once
+PRIOR = np.array([initialize_probs()[pay] for pay in range(PAYOUT_LEVELS)])
+PRIOR.flags.writeable = False
+
+
+# Online estimate of the probability that a player switches away from each payout level, for the selfish alg:
+# (prior * pseudo_count + times switched) / (pseudo_count + times observed), per level
+# update() takes a whole batch of observations in one array op; past observations are weighted down
+# by decay at every update (1 = plain counts). predict() returns the estimate kept from the last update
+# Sharded like the game: each group only ever updates its own estimator, readers merge the shards
+class SwitchEstimator:
+	def __init__(self, prior=PRIOR, pseudo_count=PSEUDO_COUNT, decay=1.0, counts=None):
+		self.prior = np.array(prior, dtype=float)
+		self.prior.flags.writeable = False
+		self.pseudo_count = float(pseudo_count)
+		self.decay = float(decay)
+		if counts is None:
+			counts = np.zeros((2, PAYOUT_LEVELS))
+		self.counts = np.array(counts, dtype=float)		# [times switched away from, times observed] per level
+		self._predict()
+
+	@property
+	def switched(self):
+		return self.counts[0]
+
+	@property
+	def observed(self):
+		return self.counts[1]
+
+	def _predict(self):
+		total = self.pseudo_count + self.observed
+		probs = np.divide(self.prior * self.pseudo_count + self.switched, total, out=self.prior.copy(), where=total > 0)
+		probs.flags.writeable = False
+		self._probs = probs
+
+	# payoffs = payout level of each observed player, switched = whether they switched away from it
+	def update(self, payoffs, switched):
+		payoffs = np.asarray(payoffs, dtype=np.int64)
+		if self.decay != 1:
+			self.counts *= self.decay
+		self.counts[0] += np.bincount(payoffs, weights=np.asarray(switched, dtype=float), minlength=PAYOUT_LEVELS)
+		self.counts[1] += np.bincount(payoffs, minlength=PAYOUT_LEVELS)
+		self._predict()
+
+	# copy with the observations added
+	def updated(self, payoffs, switched):
+		estimator = SwitchEstimator(self.prior, self.pseudo_count, self.decay, self.counts)
+		estimator.update(payoffs, switched)
+		return estimator
+
+	# 21-entry (read-only) array of switching probabilities per payout level
+	def predict(self):
+		return self._probs
+
+	# model field encoding: base64 of float64 [pseudo_count, decay, prior, switched, observed] (696 characters),
+	# exact, so a loaded estimator predicts the same probabilities as the one stored
+	def dumps(self):
+		params = np.concatenate([[self.pseudo_count, self.decay], self.prior, self.counts.ravel()])
+		return base64.b64encode(params.astype('<f8').tobytes()).decode('ascii')
+
+	# config = session config to build the estimator from when there is no snapshot yet
+	@classmethod
+	def loads(cls, field, config=None):
+		if not field:
+			return cls.from_config(config or {})
+		params = np.frombuffer(base64.b64decode(field), dtype='<f8')
+		return cls(params[2:2 + PAYOUT_LEVELS], params[0], params[1], params[2 + PAYOUT_LEVELS:].reshape(2, PAYOUT_LEVELS))
+
+	# session-wide estimator from the groups' shards (which share prior, pseudo_count and decay)
+	@classmethod
+	def merge(cls, shards):
+		shards = list(shards)
+		if not shards:
+			return cls()
+		first = shards[0]
+		return cls(first.prior, first.pseudo_count, first.decay, sum(shard.counts for shard in shards))
+
+	# prior, pseudo_count and decay from the session config keys switch_prior (21 probabilities),
+	# switch_pseudo_count and switch_decay
+	@classmethod
+	def from_config(cls, config):
+		return cls(config.get('switch_prior', PRIOR), config.get('switch_pseudo_count', PSEUDO_COUNT), config.get('switch_decay', 1.0))
@@ -0,0 +1,81 @@
+from otree.api import Currency as c, currency_range, Submission
+from . import views
+from ._builtin import Bot
+from .models import Constants
+import os, time
+import numpy
+from django.db import connection
+import instrumentation
+from simulation import RandomPolicy, SimConfig, ThresholdPolicy, observe
+
+# Bots play the real page sequence. Their behaviour is set by environment variables, so that
+# loadtest.py can drive many sessions at once:
+#   LOADTEST_POLICY        'threshold:<remain_at>' (default 'threshold:10') or 'random:<p_remain>:<p_switch>'
+#   LOADTEST_THINK_MEAN    mean think time on ResultsOptions in seconds, exponentially distributed (default 0)
+#   LOADTEST_TIMEOUT_RATE  probability a decision times out, submitting timeout_submission (default 0)
+#   LOADTEST_SEED          seed of the bots' choices
+# With instrumentation enabled (MATCHING_METRICS), every page step is recorded as a 'bot_step' event.
+
+
+def make_policy(spec):
+    name, *params = spec.split(':')
+    if name == 'random':
+        return RandomPolicy(*map(float, params))
+    return ThresholdPolicy(*map(int, params))
+
+
+POLICY = make_policy(os.environ.get('LOADTEST_POLICY', 'threshold:10'))
+THINK_MEAN = float(os.environ.get('LOADTEST_THINK_MEAN', 0))
+TIMEOUT_RATE = float(os.environ.get('LOADTEST_TIMEOUT_RATE', 0))
+rng = numpy.random.default_rng(int(os.environ.get('LOADTEST_SEED', 0)))
+CONFIG = SimConfig(players_per_group=Constants.players_per_group, num_rounds=Constants.num_rounds, num_sm=Constants.num_sm,
+                   init_quit_pay=Constants.init_quit_pay, dec_quit_pay=Constants.dec_quit_pay)
+
+_left = {}   # participant code --> time the bot handed over its last submission
+
+
+def record_step(bot, page):
+    """Time since the bot's previous submission (the POST, any wait page and this page's GET),
+    and the queries run since the last step of any bot in this process"""
+    if not instrumentation.ENABLED:
+        return
+    connection.force_debug_cursor = True
+    now = time.perf_counter()
+    queries = len(connection.queries_log)
+    connection.queries_log.clear()
+    if bot.participant.code in _left:
+        instrumentation.record('bot_step', session=bot.session.code, round=bot.subsession.round_number, page=page.__name__,
+                               step_ms=(now - _left[bot.participant.code]) * 1000, queries=queries)
+
+
+def left(bot):
+    _left[bot.participant.code] = time.perf_counter()
+
+
+class PlayerBot(Bot):
+
+    def play_round(self):
+        round_number = self.subsession.round_number
+        if round_number == 1:
+            record_step(self, views.MyPage)
+            left(self)
+            yield views.MyPage
+
+        # decided from the bot's own last decision: statusActive is only updated once this round's wait page
+        # has run record_decisions; a player who quits (or times out) stops deciding, leaving None after
+        if round_number != 1 and self.player.in_round(round_number - 1).offer_accepted in (None, 3):
+            return
+
+        # the round's wait page (per group or batch) is passed by the bot runner, so from round 2 on this step
+        # also times how long it took to resolve
+        record_step(self, views.ResultsOptions)
+        choice = POLICY(observe(CONFIG, round_number, self.player.payoff_current or 0, self.player.balance or 0), rng)
+        if THINK_MEAN:
+            time.sleep(rng.exponential(THINK_MEAN))
+        left(self)
+        if round_number == Constants.num_rounds:
+            yield views.ResultsOptions
+        elif rng.random() < TIMEOUT_RATE:
+            yield Submission(views.ResultsOptions, {}, timeout_happened=True, check_html=False)   # quits, as timeout_submission
+        else:
+            yield views.ResultsOptions, {'offer_accepted': choice}
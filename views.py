@@ -2,7 +2,53 @@ from otree.api import Currency as c, currency_range
 from . import models
 from ._builtin import Page, WaitPage
 from .models import Constants
-import json
+import json, os
+
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(APP_DIR, 'static', 'matchingAlg')
+CREDITS_PATH = os.path.join(STATIC_DIR, "image_credits.json")
+
+# static page metadata, shared by all pages of the process
+MAIN_IMAGE_PATH = "matchingAlg/main1.jpg"
+PLAY_IMAGE_PATHS = {status: "matchingAlg/play{}.jpg".format(status) for status in [1, 2]}     # remain, switch
+
+_credits = {'mtime': None, 'credits': None}
+
+
+def image_credits():
+    """Image credit per slot machine id, re-read only when the file changes"""
+    mtime = os.path.getmtime(CREDITS_PATH)
+    if _credits['mtime'] != mtime:
+        with open(CREDITS_PATH) as source:
+            _credits['credits'] = json.loads(source.read())
+        _credits['mtime'] = mtime
+    return _credits['credits']
+
+
+def _slot_machine_images():
+    """Static path of each slot machine's image, by id (images are .jpg or .jpeg)"""
+    images = {}
+    for file_name in os.listdir(STATIC_DIR):
+        sm_id, ext = os.path.splitext(file_name)
+        if sm_id.isdigit() and ext in ('.jpg', '.jpeg'):
+            images[sm_id] = "matchingAlg/{}".format(file_name)
+    return images
+
+
+SLOT_MACHINE_IMAGES = _slot_machine_images()
+
+
+def validate_assets():
+    """Every slot machine id the game can assign needs an image and a credit"""
+    credits = image_credits()
+    missing = [sm_id for sm_id in map(str, range(Constants.num_sm))
+               if sm_id not in SLOT_MACHINE_IMAGES or sm_id not in credits]
+    if missing:
+        raise ValueError("no image or image credit for slot machines %s in %s" % (', '.join(missing), STATIC_DIR))
+
+
+validate_assets()
 
 
 class MyPage(Page):
@@ -11,31 +57,45 @@ class MyPage(Page):
         return self.round_number == 1
 
     def vars_for_template(self):
-        return {'main_image_path': "matchingAlg\main1.jpg"}
+        return {'main_image_path': MAIN_IMAGE_PATH}
+
 
+class ResultsWaitAllGroups(WaitPage):
+    """batch_matching mode: match every group of the round in one call"""
+    wait_for_all_groups = True
 
-class ResultsWaitPage(Page):
     def is_displayed(self):
-        return self.round_number != 1 and self.player.participant.vars.get('statusActive')
+        return self.round_number != 1 and self.session.config.get('batch_matching')
+
+    def after_all_players_arrive(self):
+        self.subsession.before_next_round()
+
+
+class ResultsWaitPage(WaitPage):
+    """Match the group for the round once all its players have arrived
+    shown to players who quit as well, so that the group's last arrival always runs the matching"""
+    template_name = 'matchingAlg/ResultsWaitPage.html'
+
+    def is_displayed(self):
+        return self.round_number != 1 and not self.session.config.get('batch_matching')
 
     def after_all_players_arrive(self):
         self.group.before_next_round()
 
     def vars_for_template(self):
-        return {'status': self.player.in_round(self.round_number-1).offer_accepted,
-                'image_path': "matchingAlg\play{}.jpg".format(self.player.in_round(self.round_number-1).offer_accepted),
+        status = self.player.in_round(self.round_number-1).offer_accepted
+        return {'playing': status in (1, 2),
+                'image_path': PLAY_IMAGE_PATHS.get(status),
                 }
 
 
 class ResultsOptions(Page):
     """Player: Choose whether to return, switch, or quit slot machines"""
     def vars_for_template(self):
-        with open("matchingAlg/static/matchingAlg/image_credits.json") as source:
-            credit_source = json.loads(source.read())
-        return {'balance': sum([p.payoff for p in self.player.in_all_rounds()]),
+        return {'balance': self.player.balance,
                 'rounds_remaining': Constants.num_rounds - self.round_number,
-                'image_path': "matchingAlg/{}.jpg".format(self.player.current_slot_machine_id),
-                'image_credit': credit_source[str(self.player.current_slot_machine_id)],
+                'image_path': SLOT_MACHINE_IMAGES[self.player.current_slot_machine_id],
+                'image_credit': image_credits()[self.player.current_slot_machine_id],
                 'quit_pay': self.player.quit_payoff()
                 }
 
@@ -45,12 +105,22 @@ class ResultsOptions(Page):
     timeout_seconds = Constants.timeout_seconds
     timeout_submission = {'offer_accepted': 3}  # player quits if times out
 
+    def get_form_fields(self):
+        if self.round_number == Constants.num_rounds:
+            return []   # no next round to decide about
+        return self.form_fields
+
     def is_displayed(self):
         return self.player.participant.vars.get('statusActive')
 
+    def before_next_page(self):
+        if self.session.config.get('async_matching'):
+            self.group.plan_next_round()
+
 
 page_sequence = [
     MyPage,
+    ResultsWaitAllGroups,
     ResultsWaitPage,
     ResultsOptions
 ]